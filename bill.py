@@ -0,0 +1,162 @@
+import html
+import threading
+from collections import OrderedDict
+from decimal import ROUND_DOWN, Decimal
+from typing import Union
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+from models import Order, OrderItem, Product
+from schemes import Bill, BillLine
+from timeUtils import to_local
+
+CENT = Decimal("0.01")
+RECEIPT_WIDTH = 40
+CACHE_MAX_ENTRIES = 256
+
+# Rendered bills keyed by (order_id, version, split, format); any change to
+# the order or its items bumps the version. Product names are rendered too,
+# so product edits clear the cache with invalidate_bills().
+_cache: "OrderedDict[tuple, Union[Bill, str]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _money(value) -> Decimal:
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def split_amount(amount: Decimal, parts: int) -> list[Decimal]:
+    # Equal shares rounded down to the cent, leftover cents go to the first
+    # shares so they always add up to the amount
+    share = (amount / parts).quantize(CENT, rounding=ROUND_DOWN)
+    leftover_cents = int((amount - share * parts) / CENT)
+    return [share + CENT if i < leftover_cents else share for i in range(parts)]
+
+
+def compute_bill(db: Session, order: Order, split: int) -> Bill:
+    # One aggregate over the order's billable items, grouped by product
+    rows = (
+        db.query(
+            Product.id,
+            Product.name,
+            func.sum(OrderItem.quantity).label("quantity"),
+            func.sum(OrderItem.amount).label("subtotal"),
+            func.sum(case((OrderItem.paid.is_(True), OrderItem.amount), else_=0)).label(
+                "paid"
+            ),
+        )
+        .join(Product, Product.id == OrderItem.product_id)
+        .filter(OrderItem.order_id == order.id, OrderItem.status != "canceled")
+        .group_by(Product.id, Product.name)
+        .order_by(Product.name.asc())
+        .all()
+    )
+
+    lines = [
+        BillLine(
+            product_id=row.id,
+            name=row.name,
+            quantity=row.quantity,
+            subtotal=_money(row.subtotal),
+            paid=_money(row.paid),
+        )
+        for row in rows
+    ]
+    total = sum((_money(row.subtotal) for row in rows), Decimal("0.00"))
+    paid = sum((_money(row.paid) for row in rows), Decimal("0.00"))
+    unpaid = total - paid
+
+    return Bill(
+        order_id=order.id,
+        table_number=order.table_number,
+        order_time=to_local(order.order_time).strftime("%Y-%m-%d %H:%M:%S"),
+        version=order.version,
+        lines=lines,
+        total=total,
+        paid=paid,
+        unpaid=unpaid,
+        split=split,
+        shares=split_amount(unpaid, split),
+    )
+
+
+def _row(label: str, amount: float) -> str:
+    # Label left, amount right, padded to the receipt width
+    value = f"{amount:.2f}"
+    label_width = RECEIPT_WIDTH - len(value)
+    return f"{label[: label_width - 1]:<{label_width}}{value}"
+
+
+def render_text(bill: Bill) -> str:
+    rule = "-" * RECEIPT_WIDTH
+    lines = [
+        f"Order #{bill.order_id} - Table {bill.table_number}",
+        bill.order_time,
+        rule,
+        *(_row(f"{line.quantity} x {line.name}", line.subtotal) for line in bill.lines),
+        rule,
+        _row("Total", bill.total),
+        _row("Paid", bill.paid),
+        _row("Unpaid", bill.unpaid),
+    ]
+    if bill.split > 1:
+        lines.append(f"Split {bill.split} ways")
+        lines.extend(
+            _row(f"  Share {i}", share) for i, share in enumerate(bill.shares, start=1)
+        )
+    return "\n".join(lines) + "\n"
+
+
+def render_html(bill: Bill) -> str:
+    rows = "".join(
+        f"<tr><td>{line.quantity}</td><td>{html.escape(line.name)}</td>"
+        f"<td>{line.subtotal:.2f}</td></tr>"
+        for line in bill.lines
+    )
+    summary = "".join(
+        f'<tr><th colspan="2">{label}</th><td>{amount:.2f}</td></tr>'
+        for label, amount in [
+            ("Total", bill.total),
+            ("Paid", bill.paid),
+            ("Unpaid", bill.unpaid),
+        ]
+    )
+    if bill.split > 1:
+        summary += "".join(
+            f'<tr><th colspan="2">Share {i} of {bill.split}</th>'
+            f"<td>{share:.2f}</td></tr>"
+            for i, share in enumerate(bill.shares, start=1)
+        )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        f"<title>Order #{bill.order_id}</title></head><body>"
+        f"<h1>Order #{bill.order_id} - Table {bill.table_number}</h1>"
+        f"<p>{bill.order_time}</p>"
+        f"<table><tbody>{rows}</tbody><tfoot>{summary}</tfoot></table>"
+        "</body></html>"
+    )
+
+
+RENDERERS = {"text": render_text, "html": render_html}
+
+
+def invalidate_bills() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def get_bill(db: Session, order: Order, split: int, output: str) -> Union[Bill, str]:
+    cache_key = (order.id, order.version, split, output)
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            return _cache[cache_key]
+
+    bill = compute_bill(db, order, split)
+    rendered = RENDERERS[output](bill) if output in RENDERERS else bill
+
+    with _cache_lock:
+        _cache[cache_key] = rendered
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+    return rendered
@@ -0,0 +1,72 @@
+from typing import Union
+from fastapi import HTTPException, status
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.exc import StaleDataError
+
+
+def parse_if_match(if_match: Union[str, None]) -> Union[int, None]:
+    # Accepts 3, "3" and W/"3"; "*" or a missing header means any version
+    if if_match is None:
+        return None
+
+    value = if_match.strip()
+    if value == "*":
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid If-Match header."
+        )
+
+
+def format_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def check_if_match(obj, if_match: Union[str, None]) -> None:
+    expected_version = parse_if_match(if_match)
+    if expected_version is not None and expected_version != obj.version:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Version mismatch, reload and try again.",
+        )
+
+
+def touch(obj) -> None:
+    # Force a versioned UPDATE on the next flush even if no column changed,
+    # so a parent order notices changes made to its items.
+    flag_modified(obj, "status")
+
+
+class ConcurrentModification(HTTPException):
+    # A lost optimistic-lock race; retrying against fresh rows may succeed
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Resource was modified concurrently, reload and try again.",
+        )
+
+
+def flush_or_conflict(db: Session) -> None:
+    # Same as commit_or_conflict for writes that commit later, together with
+    # other rows in the same transaction
+    try:
+        db.flush()
+    except StaleDataError:
+        db.rollback()
+        raise ConcurrentModification()
+
+
+def commit_or_conflict(db: Session) -> None:
+    # Versioned rows are written with UPDATE ... WHERE id=:id AND version=:v,
+    # a concurrent writer makes that match zero rows and raises StaleDataError.
+    try:
+        db.commit()
+    except StaleDataError:
+        db.rollback()
+        raise ConcurrentModification()
@@ -1,12 +1,29 @@
+import asyncio
+import logging
 import os
-from typing import Generator
+import threading
+import time
+from typing import Generator, Union
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, Session
 
+load_dotenv()
+
 ENV = os.getenv("ENV", "development")
 TURSO_DATABASE_URL = os.getenv("TURSO_DATABASE_URL")
 TURSO_AUTH_TOKEN = os.getenv("TURSO_AUTH_TOKEN")
 
+# Optional read replica: a local embedded replica file synced from Turso,
+# or a second database URL
+READ_REPLICA_PATH = os.getenv("READ_REPLICA_PATH")
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL")
+REPLICA_MAX_STALENESS_SECONDS = float(os.getenv("REPLICA_MAX_STALENESS_SECONDS", "5"))
+REPLICA_SYNC_INTERVAL_SECONDS = float(os.getenv("REPLICA_SYNC_INTERVAL_SECONDS", "1"))
+
+logger = logging.getLogger(__name__)
+
 DB_URL = ""
 if ENV == "development":
     DB_URL = "sqlite:///./local_database.db"
@@ -27,6 +44,100 @@ def _enable_foreign_keys(dbapi_connection, connection_record):
 
 event.listen(engine, "connect", _enable_foreign_keys)
 
+read_engine = None
+if READ_REPLICA_PATH:
+    read_engine = create_engine(
+        f"sqlite+libsql:///{READ_REPLICA_PATH}",
+        connect_args={
+            "check_same_thread": False,
+            "sync_url": TURSO_DATABASE_URL,
+            "auth_token": TURSO_AUTH_TOKEN,
+        },
+        echo=True,
+    )
+elif READ_DATABASE_URL:
+    read_engine = create_engine(
+        READ_DATABASE_URL, connect_args={"check_same_thread": False}, echo=True
+    )
+ReadSessionLocal = sessionmaker(bind=read_engine) if read_engine else None
+
+# Monotonic times of the last committed write through this process and of
+# the start of the last successful embedded replica sync
+_replica_state = {"written_at": 0.0, "synced_at": None}
+_replica_lock = threading.Lock()
+
+
+def _note_flush(session, flush_context) -> None:
+    session.info["wrote"] = True
+
+
+def _mark_primary_write(session) -> None:
+    # Recorded on commit, not flush, so a sync that runs between a write's
+    # flush and its commit can't count as having seen that write
+    if session.info.pop("wrote", False):
+        _replica_state["written_at"] = time.monotonic()
+
+
+def _discard_write(session, previous_transaction) -> None:
+    session.info.pop("wrote", None)
+
+
+event.listen(SessionLocal, "after_flush", _note_flush)
+event.listen(SessionLocal, "after_commit", _mark_primary_write)
+event.listen(SessionLocal, "after_soft_rollback", _discard_write)
+
+
+def _sync_replica() -> None:
+    started_at = time.monotonic()
+    try:
+        connection = read_engine.raw_connection()
+        try:
+            connection.driver_connection.sync()
+        finally:
+            connection.close()
+    except Exception:
+        logger.warning("Read replica sync failed, reading from primary")
+        return
+
+    with _replica_lock:
+        _replica_state["synced_at"] = started_at
+
+
+async def run_replica_sync() -> None:
+    while True:
+        await run_in_threadpool(_sync_replica)
+        await asyncio.sleep(REPLICA_SYNC_INTERVAL_SECONDS)
+
+
+def start_replica_sync() -> Union[asyncio.Task, None]:
+    # The embedded replica syncs in the background so requests never wait
+    # on the network; until it catches up, reads go to the primary
+    if not READ_REPLICA_PATH:
+        return None
+    return asyncio.create_task(run_replica_sync())
+
+
+def _replica_is_fresh() -> bool:
+    # The replica may serve a read only if it has seen this process's last
+    # committed write and is within the staleness bound; otherwise read the
+    # primary.
+    now = time.monotonic()
+    with _replica_lock:
+        written_at = _replica_state["written_at"]
+        if not READ_REPLICA_PATH:
+            # A remote replica syncs on its own; assume it lags by at most
+            # the bound
+            return now - written_at > REPLICA_MAX_STALENESS_SECONDS
+
+        # A write committed during a sync may be missing from the replica,
+        # so synced_at is the time the sync started
+        synced_at = _replica_state["synced_at"]
+        return (
+            synced_at is not None
+            and synced_at >= written_at
+            and now - synced_at <= REPLICA_MAX_STALENESS_SECONDS
+        )
+
 
 def get_db() -> Generator[Session, None, None]:
     db = SessionLocal()
@@ -34,3 +145,16 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+def get_read_db() -> Generator[Session, None, None]:
+    # For GET endpoints; mutating endpoints keep using get_db
+    session_factory = SessionLocal
+    if ReadSessionLocal is not None and _replica_is_fresh():
+        session_factory = ReadSessionLocal
+
+    db = session_factory()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Union
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from concurrency import commit_or_conflict
+from models import IdempotencyKey
+from timeUtils import utcnow
+
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+CACHE_MAX_ENTRIES = 1024
+
+# In-memory LRU in front of the idempotency_keys table, holding only
+# completed responses: (expires_at, fingerprint, status_code, body)
+_cache: "OrderedDict[tuple[int, str], tuple]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(cache_key: tuple[int, str]) -> Union[tuple, None]:
+    with _cache_lock:
+        entry = _cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] <= utcnow():
+            del _cache[cache_key]
+            return None
+        _cache.move_to_end(cache_key)
+        return entry
+
+
+def _cache_put(cache_key: tuple[int, str], entry: tuple) -> None:
+    with _cache_lock:
+        _cache[cache_key] = entry
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def request_fingerprint(scope: str, payload: Any) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True)
+    return hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+
+def _replay(fingerprint: str, entry_fingerprint: str, status_code, body):
+    if entry_fingerprint != fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used for a different request.",
+        )
+    if status_code is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still being processed.",
+        )
+    return JSONResponse(
+        status_code=status_code,
+        content=body,
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+def find_stored_response(
+    db: Session, user_id: int, key: str
+) -> Union[tuple[str, Union[int, None], Any], None]:
+    # (fingerprint, status_code, body) for a live key; status_code is None
+    # while the original request is still in flight
+    entry = _cache_get((user_id, key))
+    if entry is not None:
+        return entry[1:]
+
+    record = (
+        db.query(IdempotencyKey)
+        .filter(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+        .first()
+    )
+    if not record:
+        return None
+
+    if record.expires_at <= utcnow():
+        db.delete(record)
+        db.flush()
+        return None
+
+    return record.fingerprint, record.status_code, record.response_body
+
+
+def find_idempotent_response(
+    db: Session, user_id: int, key: Union[str, None], fingerprint: str
+) -> Union[JSONResponse, None]:
+    # Returns the stored response when this request is a replay
+    if key is None:
+        return None
+
+    stored = find_stored_response(db, user_id, key)
+    if stored is None:
+        return None
+
+    return _replay(fingerprint, *stored)
+
+
+def claim_idempotency_key(
+    db: Session, user_id: int, key: Union[str, None], fingerprint: str
+) -> Union[IdempotencyKey, None]:
+    # The key row is flushed before the write it guards and committed with
+    # it, so a concurrent retry fails here instead of writing twice.
+    if key is None:
+        return None
+
+    record = IdempotencyKey(
+        user_id=user_id,
+        key=key,
+        fingerprint=fingerprint,
+        expires_at=utcnow() + IDEMPOTENCY_KEY_TTL,
+    )
+    db.add(record)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still being processed.",
+        )
+    return record
+
+
+def commit_idempotent_response(
+    db: Session,
+    record: Union[IdempotencyKey, None],
+    status_code: int,
+    body: Any,
+) -> None:
+    # Stores the response on the key row and commits it in the same
+    # transaction as the write it guards, so a committed write always has
+    # its response to replay
+    entry = None
+    if record is not None:
+        content = jsonable_encoder(body)
+        record.status_code = status_code
+        record.response_body = content
+        entry = (record.expires_at, record.fingerprint, status_code, content)
+        cache_key = (record.user_id, record.key)
+
+    commit_or_conflict(db)
+
+    if entry is not None:
+        _cache_put(cache_key, entry)
+
+
+def prune_expired_idempotency_keys(db: Session) -> int:
+    deleted = (
+        db.query(IdempotencyKey)
+        .filter(IdempotencyKey.expires_at <= utcnow())
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
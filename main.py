@@ -1,26 +1,60 @@
+import orders
 import schemes
 import os
-from typing import Annotated, Union
+from contextlib import asynccontextmanager
+from typing import Annotated, Literal, Union
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from sqlalchemy.orm import Session
 from models import Base, Product, Order, OrderItem
-from db import engine, get_db
+from db import engine, get_db, get_read_db, start_replica_sync
+from migrations import run_migrations
+from concurrency import check_if_match, commit_or_conflict, format_etag, touch
+from idempotency import (
+    claim_idempotency_key,
+    commit_idempotent_response,
+    find_idempotent_response,
+    request_fingerprint,
+)
+from tables import get_tables_summary, invalidate_tables_summary
+from ratelimit import ConcurrencyLimitMiddleware, RateLimitMiddleware
+from writequeue import enqueue_write, read_queued_write, start_drainer
+from search import index_product, remove_product_from_index, search_products
+from scheduler import JOBS, start_scheduler
+from bill import get_bill, invalidate_bills
 from auth import authenticate_user, register_user, get_db_user_by_email
 from jwtUtils import create_access_token, decode_and_verify_token
+from timeUtils import to_local, utcnow
 from datetime import datetime
 from security import oauth2_scheme
-from sqlalchemy import DateTime
 from datetime import timedelta
 
 load_dotenv()
 
 
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = start_scheduler()
+    for task in (start_drainer(), start_replica_sync()):
+        if task:
+            tasks.append(task)
+    yield
+    for task in tasks:
+        task.cancel()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Admission control, added before CORS so rejections still carry CORS headers
+app.add_middleware(ConcurrencyLimitMiddleware)
+app.add_middleware(RateLimitMiddleware)
 
 # CORS
 app.add_middleware(
@@ -47,10 +81,10 @@ def custom_openapi():
     return {"msg": "Hello World"}
 
 
-# Helper function to convert datetime to string
-def format_datetime(dt_obj: Union[DateTime, datetime]) -> str:
+# Helper function to convert a stored UTC datetime to a venue local string
+def format_datetime(dt_obj: datetime) -> str:
     if isinstance(dt_obj, datetime):
-        return dt_obj.strftime("%Y-%m-%d %H:%M:%S")
+        return to_local(dt_obj).strftime("%Y-%m-%d %H:%M:%S")
     raise TypeError("Unsupported type for datetime formatting")
 
 
@@ -91,7 +125,7 @@ def signup(
 @app.get("/me", response_model=schemes.UserBase, tags=["user"])
 def read_user(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decoded = decode_and_verify_token(token)
     user = get_db_user_by_email(db, decoded["email"])
@@ -105,13 +139,40 @@ def read_user(
 
 
 # Products
+@app.get(
+    "/products/search",
+    response_model=list[schemes.ProductPublic],
+    tags=["products"],
+)
+def search_products_by_name(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    q: str = "",
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    db: Session = Depends(get_read_db),
+):
+    decode_and_verify_token(token)
+
+    products = search_products(db, q, limit)
+
+    return [
+        schemes.ProductPublic(
+            id=product.id,
+            name=product.name,
+            description=product.description,
+            price=product.price,
+            archived=product.archived,
+        )
+        for product in products
+    ]
+
+
 @app.get(
     "/products/{product_id}", response_model=schemes.ProductCreate, tags=["products"]
 )
 def read_product(
     product_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decode_and_verify_token(token)
     product = db.query(Product).filter(Product.id == product_id).first()
@@ -133,6 +194,8 @@ def create_product(
 
     new_product = Product(**form_data.model_dump())
     db.add(new_product)
+    db.flush()
+    index_product(db, new_product)
     db.commit()
     db.refresh(new_product)
     return new_product
@@ -141,7 +204,7 @@ def create_product(
 @app.get("/products", response_model=list[schemes.ProductPublic], tags=["products"])
 def read_products(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decode_and_verify_token(token)
 
@@ -179,7 +242,9 @@ def update_product(
     for key, value in form_data.model_dump().items():
         setattr(product, key, value)
 
+    index_product(db, product)
     db.commit()
+    invalidate_bills()
     return product
 
 
@@ -198,7 +263,9 @@ def delete_product(
         )
 
     db.delete(product)
+    remove_product_from_index(db, product_id)
     db.commit()
+    invalidate_bills()
     return {"message": "Product was deleted successfully"}
 
 
@@ -208,24 +275,22 @@ def create_order(
     form_data: schemes.OrderCreate,
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Session = Depends(get_db),
+    idempotency_key: Annotated[Union[str, None], Header()] = None,
 ):
     decoded = decode_and_verify_token(token)
 
-    order = Order(
-        user_id=decoded["sub"],
-        status="pending",
-        table_number=form_data.table_number,
+    # Replay the stored response for retried requests
+    fingerprint = request_fingerprint("POST /orders", form_data)
+    replay = find_idempotent_response(db, decoded["sub"], idempotency_key, fingerprint)
+    if replay:
+        return replay
+    idempotency_record = claim_idempotency_key(
+        db, decoded["sub"], idempotency_key, fingerprint
     )
-    db.add(order)
-    db.commit()
-
-    order.set_local_order_time(region="America/Lima")
-    order.set_last_order_time(region="America/Lima")
-    db.commit()
 
-    db.refresh(order)
+    order = orders.create_order(db, decoded["sub"], form_data.table_number)
 
-    return schemes.OrderBase(
+    result = schemes.OrderBase(
         id=order.id,
         status=order.status,
         order_time=format_datetime(order.order_time),
@@ -239,14 +304,20 @@ def create_order(
         ),
         table_number=order.table_number,
         total=order.total,
+        version=order.version,
     )
+    commit_idempotent_response(db, idempotency_record, 201, result)
+    invalidate_tables_summary()
+
+    return result
 
 
 @app.get("/orders/{order_id}", response_model=schemes.OrderBase, tags=["orders"])
 def read_order(
     order_id: int,
+    response: Response,
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decode_and_verify_token(token)
 
@@ -256,6 +327,7 @@ def read_order(
             status_code=status.HTTP_404_NOT_FOUND, detail="Order not found."
         )
 
+    response.headers["ETag"] = format_etag(order.version)
     return schemes.OrderBase(
         id=order.id,
         status=order.status,
@@ -270,20 +342,21 @@ def read_order(
         ),
         table_number=order.table_number,
         total=order.total,
+        version=order.version,
     )
 
 
 @app.get("/orders", response_model=list[schemes.OrderBase], tags=["orders"])
 def read_orders(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decode_and_verify_token(token)
 
     orders = (
         db.query(Order)
         .order_by(Order.last_order_time.desc())
-        .filter(Order.order_time >= datetime.now() - timedelta(hours=12))
+        .filter(Order.order_time >= utcnow() - timedelta(hours=12))
         .all()
     )
 
@@ -302,11 +375,47 @@ def read_orders(
             ),
             table_number=order.table_number,
             total=order.total,
+            version=order.version,
         )
         for order in orders
     ]
 
 
+@app.get(
+    "/orders/{order_id}/bill",
+    response_model=schemes.Bill,
+    tags=["orders"],
+    responses={200: {"content": {"text/plain": {}, "text/html": {}}}},
+)
+def read_order_bill(
+    order_id: int,
+    response: Response,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    split: Annotated[int, Query(ge=1, le=50)] = 1,
+    output: Annotated[Literal["json", "text", "html"], Query(alias="format")] = "json",
+    db: Session = Depends(get_read_db),
+):
+    decode_and_verify_token(token)
+
+    order = db.query(Order).filter(Order.id == order_id).first()
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Order not found."
+        )
+
+    # Cached per order version, so reprints skip the query and rendering
+    bill = get_bill(db, order, split, output)
+    headers = {"ETag": format_etag(order.version)}
+
+    if output == "text":
+        return PlainTextResponse(bill, headers=headers)
+    if output == "html":
+        return HTMLResponse(bill, headers=headers)
+
+    response.headers.update(headers)
+    return bill
+
+
 @app.patch(
     "/orders/{order_id}/complete",
     tags=["orders"],
@@ -315,6 +424,7 @@ def complete_order(
     order_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Session = Depends(get_db),
+    if_match: Annotated[Union[str, None], Header()] = None,
 ):
     decode_and_verify_token(token)
     order = db.query(Order).filter(Order.id == order_id).first()
@@ -324,6 +434,8 @@ def complete_order(
             status_code=status.HTTP_404_NOT_FOUND, detail="Order not found."
         )
 
+    check_if_match(order, if_match)
+
     if order.status != "pending":
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -339,12 +451,26 @@ def complete_order(
                 detail="Order is not complete, can't be completed.",
             )
 
+    # Item changes bump the order version, so this fails with 409 if any
+    # item was added, canceled or toggled after the checks above.
     order.status = "completed"
-    db.commit()
+    commit_or_conflict(db)
+    invalidate_tables_summary()
 
     return {"message": "Order was completed successfully"}
 
 
+# Tables
+@app.get("/tables/summary", response_model=list[schemes.TableSummary], tags=["tables"])
+def read_tables_summary(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: Session = Depends(get_read_db),
+):
+    decode_and_verify_token(token)
+
+    return get_tables_summary(db)
+
+
 # Order Items
 @app.post(
     "/orders/{order_id}/items",
@@ -357,8 +483,16 @@ def add_items_to_order(
     items: list[schemes.OrderItemCreate],
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Session = Depends(get_db),
+    if_match: Annotated[Union[str, None], Header()] = None,
+    idempotency_key: Annotated[Union[str, None], Header()] = None,
 ):
-    decode_and_verify_token(token)
+    decoded = decode_and_verify_token(token)
+
+    # Replay the stored response for retried requests
+    fingerprint = request_fingerprint(f"POST /orders/{order_id}/items", items)
+    replay = find_idempotent_response(db, decoded["sub"], idempotency_key, fingerprint)
+    if replay:
+        return replay
 
     # Fetch the order once and validate
     order = db.query(Order).filter(Order.id == order_id).first()
@@ -368,58 +502,37 @@ def add_items_to_order(
             detail="Order not found.",
         )
 
-    result_items = []
-
-    for item in items:
-        product = db.query(Product).filter(Product.id == item.product_id).first()
+    check_if_match(order, if_match)
+    idempotency_record = claim_idempotency_key(
+        db, decoded["sub"], idempotency_key, fingerprint
+    )
 
-        # Validate product
-        if not product:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Product with id {item.product_id} not found.",
-            )
+    new_order_items = orders.add_items_to_order(db, order, items)
 
-        # Create new order item
-        new_order_item = OrderItem(
-            order_id=order_id,
-            product_id=item.product_id,
-            quantity=item.quantity,
-            amount=item.quantity * product.price,
-        )
-
-        db.add(new_order_item)
-
-        # Update order totals and times
-        new_order_item.set_local_order_time(region="America/Lima")
-        order.set_last_order_time(region="America/Lima")
-        order.total += new_order_item.amount
-
-        # Commit and refresh order item
-        db.commit()
-        db.refresh(new_order_item)
-
-        # Append the result to the list
-        result_items.append(
-            schemes.OrderItemPublic(
-                id=new_order_item.id,
-                product=schemes.ProductPublic(
-                    id=new_order_item.product_id,
-                    name=new_order_item.product.name,
-                    description=new_order_item.product.description,
-                    price=new_order_item.product.price,
-                    archived=new_order_item.product.archived,
-                ),
-                order_time=format_datetime(new_order_item.order_time),
-                quantity=new_order_item.quantity,
-                amount=new_order_item.amount,
-                status=new_order_item.status,
-                paid=new_order_item.paid,
-                order_id=new_order_item.order_id,
-            )
+    result = [
+        schemes.OrderItemPublic(
+            id=new_order_item.id,
+            product=schemes.ProductPublic(
+                id=new_order_item.product_id,
+                name=new_order_item.product.name,
+                description=new_order_item.product.description,
+                price=new_order_item.product.price,
+                archived=new_order_item.product.archived,
+            ),
+            order_time=format_datetime(new_order_item.order_time),
+            quantity=new_order_item.quantity,
+            amount=new_order_item.amount,
+            status=new_order_item.status,
+            paid=new_order_item.paid,
+            order_id=new_order_item.order_id,
+            version=new_order_item.version,
         )
+        for new_order_item in new_order_items
+    ]
+    commit_idempotent_response(db, idempotency_record, 201, result)
+    invalidate_tables_summary()
 
-    return result_items
+    return result
 
 
 @app.get(
@@ -430,7 +543,7 @@ def add_items_to_order(
 def read_order_items(
     order_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     decode_and_verify_token(token)
 
@@ -463,6 +576,7 @@ def read_order_items(
             status=order_item.status,
             paid=order_item.paid,
             order_id=order_item.order_id,
+            version=order_item.version,
         )
         for order_item in order_items
     ]
@@ -477,6 +591,7 @@ def toggle_order_item_status(
     form_data: schemes.OrderItemToggleStatus,
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Session = Depends(get_db),
+    if_match: Annotated[Union[str, None], Header()] = None,
 ):
     decode_and_verify_token(token)
 
@@ -489,6 +604,8 @@ def toggle_order_item_status(
             detail="Order item not found.",
         )
 
+    check_if_match(order_item, if_match)
+
     if status_to_toggle == "item_payment_status":
         order_item.paid = not order_item.paid
     elif status_to_toggle == "item_status":
@@ -512,7 +629,9 @@ def toggle_order_item_status(
             detail="Invalid status to toggle.",
         )
 
-    db.commit()
+    touch(order_item.order)
+    commit_or_conflict(db)
+    invalidate_tables_summary()
 
     return {"message": "Order item status was updated successfully"}
 
@@ -522,6 +641,7 @@ def cancel_order_item(
     item_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Session = Depends(get_db),
+    if_match: Annotated[Union[str, None], Header()] = None,
 ):
     decode_and_verify_token(token)
 
@@ -532,6 +652,8 @@ def cancel_order_item(
             detail="Order item not found.",
         )
 
+    check_if_match(order_item, if_match)
+
     if order_item.status == "attended" or order_item.paid:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -540,6 +662,101 @@ def cancel_order_item(
 
     order_item.order.total -= order_item.amount
     order_item.status = "canceled"
-    db.commit()
+    commit_or_conflict(db)
+    invalidate_tables_summary()
 
     return {"message": "Order item was canceled successfully"}
+
+
+# Jobs
+@app.get("/jobs", response_model=list[schemes.JobStatus], tags=["jobs"])
+def read_jobs(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: Session = Depends(get_read_db),
+):
+    verify_role("admin", token, db)
+
+    return [
+        schemes.JobStatus(
+            name=job.name,
+            interval_seconds=job.interval.total_seconds(),
+            runs=job.stats.runs,
+            failures=job.stats.failures,
+            skipped=job.stats.skipped,
+            last_run_at=format_datetime(job.stats.last_run_at)
+            if job.stats.last_run_at
+            else None,
+            last_duration=job.stats.last_duration,
+            average_duration=job.stats.total_duration / job.stats.runs
+            if job.stats.runs
+            else None,
+            last_error=job.stats.last_error,
+        )
+        for job in JOBS.values()
+    ]
+
+
+# Write queue
+@app.post(
+    "/write-queue/orders",
+    response_model=schemes.QueuedWritePublic,
+    tags=["write-queue"],
+    status_code=202,
+)
+def queue_order(
+    form_data: schemes.QueuedOrderCreate,
+    token: Annotated[str, Depends(oauth2_scheme)],
+):
+    decoded = decode_and_verify_token(token)
+
+    return enqueue_write(
+        decoded["sub"],
+        form_data.client_id,
+        "order",
+        {"table_number": form_data.table_number},
+    )
+
+
+@app.post(
+    "/write-queue/items",
+    response_model=schemes.QueuedWritePublic,
+    tags=["write-queue"],
+    status_code=202,
+)
+def queue_order_items(
+    form_data: schemes.QueuedItemsCreate,
+    token: Annotated[str, Depends(oauth2_scheme)],
+):
+    decoded = decode_and_verify_token(token)
+
+    if (form_data.order_id is None) == (form_data.order_client_id is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide either order_id or order_client_id.",
+        )
+
+    return enqueue_write(
+        decoded["sub"],
+        form_data.client_id,
+        "items",
+        form_data.model_dump(include={"order_id", "order_client_id", "items"}),
+    )
+
+
+@app.get(
+    "/write-queue/{client_id}",
+    response_model=schemes.QueuedWritePublic,
+    tags=["write-queue"],
+)
+def read_queued(
+    client_id: str,
+    token: Annotated[str, Depends(oauth2_scheme)],
+):
+    decoded = decode_and_verify_token(token)
+
+    queued_write = read_queued_write(decoded["sub"], client_id)
+    if not queued_write:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Queued write not found."
+        )
+    return queued_write
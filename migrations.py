@@ -0,0 +1,102 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from sqlalchemy import Engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+from search import rebuild_search_index
+from timeUtils import as_utc, utcnow
+
+
+# Columns added after the first release; create_all() only creates missing
+# tables, so existing databases need them added in place.
+ADDED_COLUMNS = [
+    ("orders", "version", "version INTEGER NOT NULL DEFAULT 1"),
+    ("order_items", "version", "version INTEGER NOT NULL DEFAULT 1"),
+]
+
+# Order times used to be written as America/Lima wall-clock time
+LEGACY_TIMEZONE = ZoneInfo("America/Lima")
+ORDER_TIME_COLUMNS = [
+    ("orders", ("order_time", "last_order_time")),
+    ("order_items", ("order_time",)),
+]
+
+
+def _add_missing_columns(connection) -> None:
+    inspector = inspect(connection)
+    for table, column, ddl in ADDED_COLUMNS:
+        existing = {c["name"] for c in inspector.get_columns(table)}
+        if column not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl}"))
+
+
+def _format_utc(value: str) -> str:
+    local_time = datetime.fromisoformat(value)
+    if local_time.tzinfo is None:
+        local_time = local_time.replace(tzinfo=LEGACY_TIMEZONE)
+    return as_utc(local_time).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _order_times_to_utc(connection) -> None:
+    # Rewrite every order time as UTC in one text format, so the order_time
+    # indexes compare rows the same way as the bound query parameters.
+    for table, columns in ORDER_TIME_COLUMNS:
+        rows = connection.execute(
+            text(f"SELECT id, {', '.join(columns)} FROM {table}")
+        ).all()
+        for row in rows:
+            values = {
+                column: _format_utc(value)
+                for column, value in zip(columns, row[1:])
+                if value is not None
+            }
+            if not values:
+                continue
+            assignments = ", ".join(f"{column} = :{column}" for column in values)
+            connection.execute(
+                text(f"UPDATE {table} SET {assignments} WHERE id = :id"),
+                {**values, "id": row.id},
+            )
+
+
+# One-off data migrations, applied once per database in this order
+DATA_MIGRATIONS = [
+    ("0001_order_times_to_utc", _order_times_to_utc),
+    ("0002_products_search_index", rebuild_search_index),
+]
+
+
+def _apply_data_migrations(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations "
+                "(name VARCHAR(255) PRIMARY KEY, applied_at DATETIME NOT NULL)"
+            )
+        )
+        applied = set(
+            connection.execute(text("SELECT name FROM schema_migrations")).scalars()
+        )
+
+    for name, migration in DATA_MIGRATIONS:
+        if name in applied:
+            continue
+        try:
+            # Claiming the name first makes a second worker fail here
+            # instead of applying the same migration twice.
+            with engine.begin() as connection:
+                connection.execute(
+                    text(
+                        "INSERT INTO schema_migrations (name, applied_at) "
+                        "VALUES (:name, :applied_at)"
+                    ),
+                    {"name": name, "applied_at": utcnow().isoformat()},
+                )
+                migration(connection)
+        except IntegrityError:
+            continue
+
+
+def run_migrations(engine: Engine) -> None:
+    with engine.begin() as connection:
+        _add_missing_columns(connection)
+    _apply_data_migrations(engine)
@@ -7,10 +7,31 @@ from sqlalchemy import (
     ForeignKey,
     Enum,
     DateTime,
+    JSON,
+    text,
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
-import pytz
+from typing import Union
+from timeUtils import as_utc, utcnow
+
+
+class UTCDateTime(TypeDecorator):
+    # Stores naive UTC so every row compares the same way in SQLite and
+    # returns timezone-aware UTC datetimes.
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = as_utc(value).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = as_utc(value)
+        return value
 
 
 class Base(DeclarativeBase):
@@ -56,24 +77,27 @@ class Order(Base):
     )
     table_number: Mapped[int] = mapped_column(Integer, nullable=False)
     total: Mapped[float] = mapped_column(Numeric(10, 2), default=0, nullable=False)
-    order_time: Mapped[DateTime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now(), index=True
+    order_time: Mapped[datetime] = mapped_column(
+        UTCDateTime, default=utcnow, server_default=func.now(), index=True
     )
     note: Mapped[str] = mapped_column(String(255), nullable=True, default="")
-    last_order_time: Mapped[DateTime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now(), index=True
+    last_order_time: Mapped[datetime] = mapped_column(
+        UTCDateTime, default=utcnow, server_default=func.now(), index=True
+    )
+    version: Mapped[int] = mapped_column(
+        Integer, nullable=False, server_default=text("1")
     )
 
     user: Mapped["User"] = relationship(back_populates="orders")
     items: Mapped[list["OrderItem"]] = relationship(back_populates="order")
 
-    def set_local_order_time(self, region="America/Lima"):
-        tz = pytz.timezone(region)
-        self.order_time = datetime.now(tz)
+    __mapper_args__ = {"version_id_col": version}
 
-    def set_last_order_time(self, region="America/Lima"):
-        tz = pytz.timezone(region)
-        self.last_order_time = datetime.now(tz)
+    def set_last_order_time(self, when: Union[datetime, None] = None):
+        # Replayed writes carry their original time and must not move it back
+        when = when or utcnow()
+        if self.last_order_time is None or when > self.last_order_time:
+            self.last_order_time = when
 
 
 class OrderItem(Base):
@@ -86,8 +110,8 @@ class OrderItem(Base):
     product_id: Mapped[int] = mapped_column(
         Integer, ForeignKey("products.id"), nullable=False
     )
-    order_time: Mapped[DateTime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now(), index=True
+    order_time: Mapped[datetime] = mapped_column(
+        UTCDateTime, default=utcnow, server_default=func.now(), index=True
     )
     quantity: Mapped[int] = mapped_column(Integer, nullable=False)
     amount: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
@@ -102,10 +126,32 @@ class OrderItem(Base):
         nullable=False,
     )
     paid: Mapped[bool] = mapped_column(Boolean, default=False)
+    version: Mapped[int] = mapped_column(
+        Integer, nullable=False, server_default=text("1")
+    )
 
     order: Mapped["Order"] = relationship(back_populates="items")
     product: Mapped["Product"] = relationship()
 
-    def set_local_order_time(self, region="America/Lima"):
-        tz = pytz.timezone(region)
-        self.order_time = datetime.now(tz)
+    __mapper_args__ = {"version_id_col": version}
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    status_code: Mapped[int] = mapped_column(Integer, nullable=True)
+    response_body: Mapped[dict] = mapped_column(JSON, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(
+        UTCDateTime, nullable=False, index=True
+    )
+
+
+class JobLease(Base):
+    __tablename__ = "job_leases"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(255), nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(UTCDateTime, nullable=False)
@@ -0,0 +1,109 @@
+from datetime import datetime
+from typing import Union
+from fastapi import HTTPException, status
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+from concurrency import commit_or_conflict, flush_or_conflict
+from models import Order, OrderItem, Product
+from schemes import OrderItemCreate
+from tables import invalidate_tables_summary
+from timeUtils import utcnow
+
+
+# Order writes shared by the HTTP endpoints and the write queue drainer.
+# They only flush; the caller commits once its response is stored with the
+# write, then invalidates the tables summary. The drainer passes order_time
+# so replayed writes keep the time they were taken, not the time they ran.
+def create_order(
+    db: Session,
+    user_id: int,
+    table_number: int,
+    order_time: Union[datetime, None] = None,
+) -> Order:
+    order_time = order_time or utcnow()
+    order = Order(
+        user_id=user_id,
+        status="pending",
+        table_number=table_number,
+        order_time=order_time,
+        last_order_time=order_time,
+    )
+    db.add(order)
+    db.flush()
+    return order
+
+
+def add_items_to_order(
+    db: Session,
+    order: Order,
+    items: list[OrderItemCreate],
+    order_time: Union[datetime, None] = None,
+) -> list[OrderItem]:
+    order_time = order_time or utcnow()
+    new_order_items = []
+
+    # Defer the versioned order update to the single flush below
+    with db.no_autoflush:
+        for item in items:
+            product = db.query(Product).filter(Product.id == item.product_id).first()
+
+            # Validate product
+            if not product:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Product with id {item.product_id} not found.",
+                )
+
+            # Create new order item
+            new_order_item = OrderItem(
+                order_id=order.id,
+                product_id=item.product_id,
+                quantity=item.quantity,
+                amount=item.quantity * product.price,
+                order_time=order_time,
+            )
+
+            db.add(new_order_item)
+
+            # Update order totals and times
+            order.set_last_order_time(order_time)
+            order.total += new_order_item.amount
+
+            new_order_items.append(new_order_item)
+
+    # Write all items together with the versioned order update
+    flush_or_conflict(db)
+
+    return new_order_items
+
+
+def reconcile_order_totals(db: Session) -> int:
+    # Recomputes pending order totals from their billable items and fixes
+    # any drift; returns the number of orders corrected
+    item_totals = (
+        db.query(
+            OrderItem.order_id,
+            func.sum(
+                case((OrderItem.status != "canceled", OrderItem.amount), else_=0)
+            ).label("total"),
+        )
+        .group_by(OrderItem.order_id)
+        .subquery()
+    )
+    rows = (
+        db.query(Order, func.coalesce(item_totals.c.total, 0))
+        .outerjoin(item_totals, item_totals.c.order_id == Order.id)
+        .filter(Order.status == "pending")
+        .all()
+    )
+
+    corrected = 0
+    for order, total in rows:
+        if round(float(order.total), 2) != round(float(total), 2):
+            order.total = total
+            corrected += 1
+
+    if corrected:
+        commit_or_conflict(db)
+        invalidate_tables_summary()
+    return corrected
@@ -0,0 +1,165 @@
+import logging
+import math
+import os
+import re
+import time
+from fastapi import status
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from jwtUtils import decode_and_verify_token
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "16"))
+
+# Token bucket budgets per "METHOD /route": (tokens per second, burst)
+DEFAULT_BUDGET = (5.0, 20)
+ROUTE_BUDGETS = {
+    "POST /login": (0.2, 5),
+    "POST /signup": (0.1, 3),
+    "GET /orders": (1.0, 5),
+    "GET /products": (1.0, 5),
+    "GET /tables/summary": (1.0, 5),
+    "GET /orders/{id}/items": (2.0, 10),
+}
+
+MAX_BUCKETS = 10_000
+# A bucket idle this long has refilled completely and can be dropped
+BUCKET_IDLE_SECONDS = max(
+    burst / rate for rate, burst in [DEFAULT_BUDGET, *ROUTE_BUDGETS.values()]
+)
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def route_key(method: str, path: str) -> str:
+    # /orders/12/items -> /orders/{id}/items
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+def client_key(request) -> str:
+    # Keyed by the JWT subject, falling back to the client address
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return f"user:{decode_and_verify_token(token)['sub']}"
+        except Exception:
+            pass
+    host = request.client.host if request.client else "unknown"
+    return f"ip:{host}"
+
+
+class InMemoryBucketStore:
+    def __init__(self):
+        self.buckets: dict[str, tuple[float, float]] = {}
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        # Returns 0 when a token was taken, otherwise seconds until one is free
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > MAX_BUCKETS:
+            self._prune(now)
+        return wait
+
+    def _prune(self, now: float) -> None:
+        for key, (_, updated_at) in list(self.buckets.items()):
+            if now - updated_at > BUCKET_IDLE_SECONDS:
+                del self.buckets[key]
+
+
+class RedisBucketStore:
+    # Shared buckets so every worker/instance enforces the same budget
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.fallback = InMemoryBucketStore()
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        try:
+            wait = await self.script(
+                keys=[f"ratelimit:{key}"], args=[rate, burst, time.time()]
+            )
+            return float(wait)
+        except Exception:
+            logger.warning("Rate limit store unavailable, using local buckets")
+            return await self.fallback.take(key, rate, burst)
+
+
+def create_bucket_store():
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            return RedisBucketStore(RATE_LIMIT_REDIS_URL)
+        except ImportError:
+            logger.warning("redis is not installed, using local buckets")
+    return InMemoryBucketStore()
+
+
+class RateLimitMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, store=None):
+        super().__init__(app)
+        self.store = store or create_bucket_store()
+
+    async def dispatch(self, request, call_next):
+        if request.method == "OPTIONS":
+            return await call_next(request)
+
+        route = route_key(request.method, request.url.path)
+        rate, burst = ROUTE_BUDGETS.get(route, DEFAULT_BUDGET)
+        wait = await self.store.take(f"{client_key(request)}:{route}", rate, burst)
+
+        if wait > 0:
+            return JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={"detail": "Too many requests."},
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+        return await call_next(request)
+
+
+class ConcurrencyLimitMiddleware(BaseHTTPMiddleware):
+    # Sheds load before requests queue up behind the database connections
+    def __init__(self, app, max_concurrent: int = MAX_CONCURRENT_REQUESTS):
+        super().__init__(app)
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+
+    async def dispatch(self, request, call_next):
+        if self.in_flight >= self.max_concurrent:
+            return JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"detail": "Server is busy, try again shortly."},
+                headers={"Retry-After": "1"},
+            )
+
+        self.in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Union
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from db import SessionLocal, engine
+from idempotency import prune_expired_idempotency_keys
+from migrations import run_migrations
+from models import Base, JobLease
+from orders import reconcile_order_totals
+from timeUtils import utcnow
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class JobStats:
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0
+    last_run_at: Union[datetime, None] = None
+    last_duration: Union[float, None] = None
+    total_duration: float = 0.0
+    last_error: Union[str, None] = None
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[Session], object]
+    interval: timedelta
+    jitter: timedelta
+    stats: JobStats = field(default_factory=JobStats)
+
+
+JOBS: dict[str, Job] = {}
+
+
+def register_job(
+    name: str, func: Callable[[Session], object], interval: timedelta, jitter=None
+) -> None:
+    JOBS[name] = Job(
+        name=name,
+        func=func,
+        interval=interval,
+        jitter=jitter if jitter is not None else interval / 10,
+    )
+
+
+def acquire_lease(db: Session, name: str, ttl: timedelta) -> bool:
+    # The lease row doubles as "next run due": it is held for a whole
+    # interval, so only one worker runs the job per interval.
+    now = utcnow()
+    result = db.execute(
+        update(JobLease)
+        .where(JobLease.name == name, JobLease.expires_at <= now)
+        .values(owner=WORKER_ID, expires_at=now + ttl)
+    )
+    if result.rowcount == 1:
+        db.commit()
+        return True
+
+    db.rollback()
+    if db.get(JobLease, name) is not None:
+        return False
+
+    db.add(JobLease(name=name, owner=WORKER_ID, expires_at=now + ttl))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
+
+
+def release_lease(db: Session, name: str) -> None:
+    db.execute(
+        update(JobLease)
+        .where(JobLease.name == name, JobLease.owner == WORKER_ID)
+        .values(expires_at=utcnow())
+    )
+    db.commit()
+
+
+def run_job(name: str, force: bool = False) -> bool:
+    # Returns True if the job ran; force skips the lease (on-demand runs)
+    job = JOBS[name]
+    with SessionLocal() as db:
+        if not force and not acquire_lease(db, name, job.interval):
+            job.stats.skipped += 1
+            return False
+
+        started = time.perf_counter()
+        job.stats.last_run_at = utcnow()
+        try:
+            result = job.func(db)
+        except Exception as e:
+            db.rollback()
+            job.stats.failures += 1
+            job.stats.last_error = str(e)
+            logger.exception("Job %s failed", name)
+            # Let the next tick, on any worker, retry it
+            if not force:
+                release_lease(db, name)
+            return True
+        finally:
+            duration = time.perf_counter() - started
+            job.stats.runs += 1
+            job.stats.last_duration = duration
+            job.stats.total_duration += duration
+
+        job.stats.last_error = None
+        logger.info("Job %s finished in %.3fs: %s", name, duration, result)
+        return True
+
+
+async def _run_periodically(job: Job) -> None:
+    while True:
+        delay = job.interval + random.uniform(0, 1) * job.jitter
+        await asyncio.sleep(delay.total_seconds())
+        try:
+            await run_in_threadpool(run_job, job.name)
+        except Exception:
+            logger.exception("Scheduling job %s failed", job.name)
+
+
+def start_scheduler() -> list[asyncio.Task]:
+    if not SCHEDULER_ENABLED:
+        return []
+    return [asyncio.create_task(_run_periodically(job)) for job in JOBS.values()]
+
+
+register_job(
+    "prune_idempotency_keys", prune_expired_idempotency_keys, timedelta(hours=1)
+)
+register_job("reconcile_order_totals", reconcile_order_totals, timedelta(minutes=15))
+
+
+def main() -> None:
+    # On-demand runs for serverless deployments without a long-lived process:
+    #   python scheduler.py list
+    #   python scheduler.py run reconcile_order_totals [--force]
+    parser = argparse.ArgumentParser(description="Run maintenance jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list")
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("job", choices=[*JOBS, "all"])
+    run_parser.add_argument("--force", action="store_true", help="ignore leases")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for job in JOBS.values():
+            print(f"{job.name}\tevery {job.interval}")
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+
+    names = list(JOBS) if args.job == "all" else [args.job]
+    for name in names:
+        ran = run_job(name, force=args.force)
+        stats = JOBS[name].stats
+        if not ran:
+            print(f"{name}: skipped, lease held by another worker")
+        elif stats.last_error:
+            print(f"{name}: failed after {stats.last_duration:.3f}s")
+        else:
+            print(f"{name}: done in {stats.last_duration:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, SecretStr
-from typing import Literal
+from typing import Literal, Union
 
 
 class Token(BaseModel):
@@ -54,6 +54,7 @@ class OrderBase(BaseModel):
     user: UserBase
     table_number: int
     total: float
+    version: int
 
 
 class OrderCreate(BaseModel):
@@ -83,7 +84,69 @@ class OrderItemPublic(BaseModel):
     status: str
     paid: bool
     order_id: int
+    version: int
 
 
 class OrderItemToggleStatus(BaseModel):
     status: Literal["item_status", "item_payment_status"]
+
+
+class TableSummary(BaseModel):
+    table_number: int
+    order_id: int
+    total: float
+    unpaid: float
+    pending_items: int
+
+
+class QueuedOrderCreate(BaseModel):
+    client_id: str
+    table_number: int
+
+
+class QueuedItemsCreate(BaseModel):
+    client_id: str
+    order_id: Union[int, None] = None
+    order_client_id: Union[str, None] = None
+    items: list[OrderItemCreate]
+
+
+class QueuedWritePublic(BaseModel):
+    client_id: str
+    kind: str
+    status: str
+    server_id: Union[int, None]
+    error: Union[str, None]
+
+
+class JobStatus(BaseModel):
+    name: str
+    interval_seconds: float
+    runs: int
+    failures: int
+    skipped: int
+    last_run_at: Union[str, None]
+    last_duration: Union[float, None]
+    average_duration: Union[float, None]
+    last_error: Union[str, None]
+
+
+class BillLine(BaseModel):
+    product_id: int
+    name: str
+    quantity: int
+    subtotal: float
+    paid: float
+
+
+class Bill(BaseModel):
+    order_id: int
+    table_number: int
+    order_time: str
+    version: int
+    lines: list[BillLine]
+    total: float
+    paid: float
+    unpaid: float
+    split: int
+    shares: list[float]
@@ -0,0 +1,83 @@
+import re
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from models import Product
+
+# FTS5 index over product names and descriptions; unicode61 with
+# remove_diacritics folds accents so "pina" matches "Piña".
+CREATE_SEARCH_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5("
+    "name, description, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def rebuild_search_index(connection) -> None:
+    connection.execute(text(CREATE_SEARCH_TABLE))
+    connection.execute(text("DELETE FROM products_fts"))
+    connection.execute(
+        text(
+            "INSERT INTO products_fts (rowid, name, description) "
+            "SELECT id, name, description FROM products"
+        )
+    )
+
+
+def remove_product_from_index(db: Session, product_id: int) -> None:
+    db.execute(text("DELETE FROM products_fts WHERE rowid = :id"), {"id": product_id})
+
+
+def index_product(db: Session, product: Product) -> None:
+    # Runs in the caller's transaction, committed with the product write
+    remove_product_from_index(db, product.id)
+    db.execute(
+        text(
+            "INSERT INTO products_fts (rowid, name, description) "
+            "VALUES (:id, :name, :description)"
+        ),
+        {"id": product.id, "name": product.name, "description": product.description},
+    )
+
+
+def build_match_query(q: str) -> str:
+    # Every word must match as a prefix; quoting keeps FTS5 operators in
+    # user input from being interpreted
+    return " ".join(f'"{word}"*' for word in _WORD.findall(q))
+
+
+def search_products(db: Session, q: str, limit: int) -> list[Product]:
+    match_query = build_match_query(q)
+    if not match_query:
+        return []
+
+    product_ids = (
+        db.execute(
+            text(
+                "SELECT rowid FROM products_fts WHERE products_fts MATCH :query "
+                "ORDER BY bm25(products_fts, :name_weight, :description_weight) "
+                "LIMIT :limit"
+            ),
+            {
+                "query": match_query,
+                "name_weight": NAME_WEIGHT,
+                "description_weight": DESCRIPTION_WEIGHT,
+                "limit": limit,
+            },
+        )
+        .scalars()
+        .all()
+    )
+    if not product_ids:
+        return []
+
+    products = {
+        product.id: product
+        for product in db.query(Product).filter(Product.id.in_(product_ids)).all()
+    }
+    return [
+        products[product_id] for product_id in product_ids if product_id in products
+    ]
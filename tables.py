@@ -0,0 +1,74 @@
+import threading
+import time
+from sqlalchemy import and_, case, func
+from sqlalchemy.orm import Session
+from models import Order, OrderItem
+from schemes import TableSummary
+
+SUMMARY_CACHE_TTL_SECONDS = 5
+
+_summary_cache: dict = {"expires_at": 0.0, "value": None}
+_summary_lock = threading.Lock()
+
+
+def query_tables_summary(db: Session) -> list[TableSummary]:
+    # One aggregate over open orders and their items, one row per order so
+    # the figures belong to the order they link to, sorted by table
+    billable = OrderItem.status != "canceled"
+    rows = (
+        db.query(
+            Order.table_number,
+            Order.id.label("order_id"),
+            func.coalesce(
+                func.sum(case((billable, OrderItem.amount), else_=0)), 0
+            ).label("total"),
+            func.coalesce(
+                func.sum(
+                    case(
+                        (and_(billable, OrderItem.paid.is_(False)), OrderItem.amount),
+                        else_=0,
+                    )
+                ),
+                0,
+            ).label("unpaid"),
+            func.count(case((OrderItem.status == "pending", 1))).label("pending_items"),
+        )
+        .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+        .filter(Order.status == "pending")
+        .group_by(Order.table_number, Order.id)
+        .order_by(Order.table_number.asc(), Order.id.asc())
+        .all()
+    )
+
+    return [
+        TableSummary(
+            table_number=row.table_number,
+            order_id=row.order_id,
+            total=row.total,
+            unpaid=row.unpaid,
+            pending_items=row.pending_items,
+        )
+        for row in rows
+    ]
+
+
+def get_tables_summary(db: Session) -> list[TableSummary]:
+    with _summary_lock:
+        if _summary_cache["value"] is not None and (
+            _summary_cache["expires_at"] > time.monotonic()
+        ):
+            return _summary_cache["value"]
+
+    summary = query_tables_summary(db)
+
+    with _summary_lock:
+        _summary_cache["value"] = summary
+        _summary_cache["expires_at"] = time.monotonic() + SUMMARY_CACHE_TTL_SECONDS
+
+    return summary
+
+
+def invalidate_tables_summary() -> None:
+    with _summary_lock:
+        _summary_cache["value"] = None
+        _summary_cache["expires_at"] = 0.0
@@ -0,0 +1,25 @@
+import os
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Resolved once at import; timestamps are stored in UTC and only converted
+# to the venue's local time when serialized.
+VENUE_TIMEZONE = ZoneInfo(os.getenv("VENUE_TIMEZONE", "America/Lima"))
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def as_utc(dt: datetime) -> datetime:
+    # Naive datetimes coming back from SQLite are UTC
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def to_local(dt: datetime) -> datetime:
+    return as_utc(dt).astimezone(VENUE_TIMEZONE)
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Union
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import JSON, Integer, String, create_engine, event, update
+from sqlalchemy.exc import (
+    DBAPIError,
+    IntegrityError,
+    InterfaceError,
+    OperationalError,
+)
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    Session,
+    mapped_column,
+    sessionmaker,
+)
+import orders
+from concurrency import ConcurrentModification
+from db import SessionLocal
+from idempotency import (
+    claim_idempotency_key,
+    commit_idempotent_response,
+    find_stored_response,
+    request_fingerprint,
+)
+from models import Order, UTCDateTime
+from scheduler import acquire_lease, release_lease
+from schemes import OrderItemCreate
+from tables import invalidate_tables_summary
+from timeUtils import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Local durable queue for order entry while the primary is unreachable;
+# disabled unless WRITE_QUEUE_PATH is set
+WRITE_QUEUE_PATH = os.getenv("WRITE_QUEUE_PATH")
+DRAIN_INTERVAL_SECONDS = float(os.getenv("WRITE_QUEUE_DRAIN_INTERVAL_SECONDS", "2"))
+DRAIN_BATCH_SIZE = 50
+DRAIN_LEASE_NAME = "drain_write_queue"
+# Queued writes share the idempotency table with Idempotency-Key headers
+QUEUE_KEY_PREFIX = "queue:"
+# Upper bound for one batch; the lease is released as soon as it finishes
+DRAIN_LEASE_TTL = timedelta(seconds=60)
+
+
+class QueueBase(DeclarativeBase):
+    pass
+
+
+class QueuedWrite(QueueBase):
+    __tablename__ = "queued_writes"
+
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    client_id: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    status: Mapped[str] = mapped_column(
+        String(16), default="queued", nullable=False, index=True
+    )
+    server_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    error: Mapped[str] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        UTCDateTime, default=utcnow, nullable=False
+    )
+
+
+queue_engine = None
+QueueSessionLocal = None
+if WRITE_QUEUE_PATH:
+    queue_engine = create_engine(
+        f"sqlite:///{WRITE_QUEUE_PATH}", connect_args={"check_same_thread": False}
+    )
+    QueueSessionLocal = sessionmaker(bind=queue_engine)
+
+    def _durable_journal(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=FULL")
+        cursor.close()
+
+    event.listen(queue_engine, "connect", _durable_journal)
+    QueueBase.metadata.create_all(bind=queue_engine)
+
+
+def _queue_session() -> Session:
+    if QueueSessionLocal is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Write queue is not enabled.",
+        )
+    return QueueSessionLocal()
+
+
+def _snapshot(entry: QueuedWrite) -> dict:
+    return {
+        "client_id": entry.client_id,
+        "kind": entry.kind,
+        "status": entry.status,
+        "server_id": entry.server_id,
+        "error": entry.error,
+    }
+
+
+def _find_owned_entry(
+    queue_db: Session, user_id: int, client_id: str
+) -> Union[QueuedWrite, None]:
+    # client_ids are unique across users, so one taken by someone else is a
+    # conflict rather than "not queued yet"
+    entry = (
+        queue_db.query(QueuedWrite)
+        .filter(QueuedWrite.client_id == client_id, QueuedWrite.user_id == user_id)
+        .first()
+    )
+    if entry is None and (
+        queue_db.query(QueuedWrite.seq)
+        .filter(QueuedWrite.client_id == client_id)
+        .first()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="client_id is already in use.",
+        )
+    return entry
+
+
+def enqueue_write(user_id: int, client_id: str, kind: str, payload: Any) -> dict:
+    # Acknowledged as soon as the entry is on local disk; a repeated
+    # client_id from the same user returns the existing entry
+    with _queue_session() as queue_db:
+        entry = _find_owned_entry(queue_db, user_id, client_id)
+        if entry:
+            return _snapshot(entry)
+
+        entry = QueuedWrite(
+            client_id=client_id, user_id=user_id, kind=kind, payload=payload
+        )
+        queue_db.add(entry)
+        try:
+            queue_db.commit()
+        except IntegrityError:
+            # A concurrent enqueue with the same client_id won
+            queue_db.rollback()
+            entry = _find_owned_entry(queue_db, user_id, client_id)
+        return _snapshot(entry)
+
+
+def read_queued_write(user_id: int, client_id: str) -> Union[dict, None]:
+    with _queue_session() as queue_db:
+        entry = (
+            queue_db.query(QueuedWrite)
+            .filter(QueuedWrite.client_id == client_id, QueuedWrite.user_id == user_id)
+            .first()
+        )
+        return _snapshot(entry) if entry else None
+
+
+class WriteInFlight(Exception):
+    # Another drainer holds this entry's idempotency key; retry later
+    pass
+
+
+def _resolve_order_id(queue_db: Session, entry: QueuedWrite) -> int:
+    payload = entry.payload
+    if payload.get("order_id") is not None:
+        return payload["order_id"]
+
+    order_entry = (
+        queue_db.query(QueuedWrite)
+        .filter(
+            QueuedWrite.client_id == payload["order_client_id"],
+            QueuedWrite.user_id == entry.user_id,
+            QueuedWrite.kind == "order",
+        )
+        .first()
+    )
+    if not order_entry or order_entry.status != "applied":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Queued order {payload['order_client_id']} was not created.",
+        )
+    return order_entry.server_id
+
+
+def _apply(db: Session, queue_db: Session, entry: QueuedWrite) -> int:
+    # Replays go through the idempotency table keyed by client_id, and the
+    # write commits together with its stored response, so an entry applied
+    # just before a crash or link drop is found here and not written twice
+    fingerprint = request_fingerprint(f"QUEUE {entry.kind}", entry.payload)
+    key = QUEUE_KEY_PREFIX + entry.client_id
+    stored = find_stored_response(db, entry.user_id, key)
+    if stored is not None:
+        if stored[0] != fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="client_id was already used for a different write.",
+            )
+        if stored[1] is None:
+            raise WriteInFlight(entry.client_id)
+        return stored[2]["id"]
+    try:
+        record = claim_idempotency_key(db, entry.user_id, key, fingerprint)
+    except HTTPException:
+        raise WriteInFlight(entry.client_id)
+
+    if entry.kind == "order":
+        order = orders.create_order(
+            db, entry.user_id, entry.payload["table_number"], entry.created_at
+        )
+    else:
+        order_id = _resolve_order_id(queue_db, entry)
+        order = db.query(Order).filter(Order.id == order_id).first()
+        if not order:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Order not found."
+            )
+        items = [OrderItemCreate(**item) for item in entry.payload["items"]]
+        orders.add_items_to_order(db, order, items, entry.created_at)
+
+    commit_idempotent_response(db, record, 201, {"id": order.id})
+    invalidate_tables_summary()
+    return order.id
+
+
+def _finish(queue_db: Session, entry: QueuedWrite, **values) -> None:
+    # Only moves an entry out of "queued", so a late drainer can't overwrite
+    # the outcome another one already recorded
+    queue_db.execute(
+        update(QueuedWrite)
+        .where(QueuedWrite.seq == entry.seq, QueuedWrite.status == "queued")
+        .values(**values)
+    )
+    queue_db.commit()
+
+
+def drain_once(batch_size: int = DRAIN_BATCH_SIZE) -> int:
+    # Entries are replayed in arrival order, which keeps each order's writes
+    # in sequence; a connection error stops the batch so nothing is skipped.
+    # A job lease keeps workers sharing the queue file from draining at once.
+    if QueueSessionLocal is None:
+        return 0
+
+    applied = 0
+    with QueueSessionLocal() as queue_db, SessionLocal() as db:
+        try:
+            if not acquire_lease(db, DRAIN_LEASE_NAME, DRAIN_LEASE_TTL):
+                return 0
+        except (OperationalError, InterfaceError):
+            db.rollback()
+            logger.warning("Primary unavailable, write queue drain paused")
+            return 0
+
+        try:
+            entries = (
+                queue_db.query(QueuedWrite)
+                .filter(QueuedWrite.status == "queued")
+                .order_by(QueuedWrite.seq.asc())
+                .limit(batch_size)
+                .all()
+            )
+            for entry in entries:
+                try:
+                    server_id = _apply(db, queue_db, entry)
+                except WriteInFlight:
+                    db.rollback()
+                    logger.warning("Queued write %s is in flight", entry.client_id)
+                    break
+                except ConcurrentModification:
+                    # The order changed under us (staff edits, reconcile job);
+                    # keep the entry and retry it against fresh rows next run
+                    db.rollback()
+                    logger.warning("Queued write %s raced an update", entry.client_id)
+                    break
+                except HTTPException as e:
+                    db.rollback()
+                    _finish(
+                        queue_db, entry, status="conflict", error=str(e.detail)[:255]
+                    )
+                    logger.warning("Queued write %s conflicted: %s", entry.client_id, e)
+                except (OperationalError, InterfaceError):
+                    db.rollback()
+                    logger.warning("Primary unavailable, write queue drain paused")
+                    break
+                except DBAPIError as e:
+                    db.rollback()
+                    _finish(queue_db, entry, status="conflict", error=str(e.orig)[:255])
+                    logger.warning("Queued write %s conflicted: %s", entry.client_id, e)
+                except Exception as e:
+                    # Anything unexpected fails only this entry; left queued it
+                    # would block every entry behind it
+                    db.rollback()
+                    _finish(queue_db, entry, status="conflict", error=str(e)[:255])
+                    logger.exception("Queued write %s failed", entry.client_id)
+                else:
+                    _finish(queue_db, entry, status="applied", server_id=server_id)
+                    applied += 1
+        finally:
+            try:
+                release_lease(db, DRAIN_LEASE_NAME)
+            except (OperationalError, InterfaceError):
+                db.rollback()
+
+    return applied
+
+
+async def run_drainer() -> None:
+    while True:
+        try:
+            await run_in_threadpool(drain_once)
+        except Exception:
+            logger.exception("Write queue drain failed")
+        await asyncio.sleep(DRAIN_INTERVAL_SECONDS)
+
+
+def start_drainer() -> Union[asyncio.Task, None]:
+    if QueueSessionLocal is None:
+        return None
+    return asyncio.create_task(run_drainer())